@@ -1,26 +1,42 @@
+import asyncio
 import csv
 import logging
 import os
+import sqlite3
+import tempfile
+import time
+import urllib.parse
+from typing import AsyncIterator, Callable
 
-from proxmoxer import ProxmoxAPI
+import aiohttp
+import orjson
+from proxmoxer import ProxmoxAPI, ResourceException
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s %(levelname)s:%(name)s: %(message)s"
 )
 
 
+TRUTHY = {"1", "true", "yes", "on"}
+
+
 class Env:
     @staticmethod
     def get_or(value: str, default: str):
-        if value in os.environ and os.environ[value] != "":
-            return value
-        return default
+        v = os.environ.get(value)
+        return v if v else default
+
+    @staticmethod
+    def get_or_truth(value: str, default: bool):
+        v = os.environ.get(value)
+        return v.strip().lower() in TRUTHY if v else default
 
     @staticmethod
     def must_get(value: str, err: str):
-        if value not in os.environ or os.environ[value] == "":
+        v = os.environ.get(value)
+        if not v:
             raise ValueError(f"{err} in environment variable {value}")
-        return os.environ[value]
+        return v
 
 
 class Config:
@@ -29,6 +45,13 @@ class Config:
     password: str
     verify_ssl: bool
     service: str
+    cache_dir: str
+    cache_ttl: int
+    key_cache: bool
+    concurrency: int
+    fields: list
+    batch_size: int
+    poll_interval: float
 
     def __init__(self):
         self.from_env()
@@ -37,8 +60,24 @@ class Config:
         self.url = Env.must_get("PROX_URL", "Must provide URL")
         self.user = Env.must_get("PROX_USER", "Must provide user")
         self.password = Env.must_get("PROX_PASSWORD", "Must provide password")
-        self.verify_ssl = Env.get_or("PROX_SSL", False)
+        self.verify_ssl = Env.get_or_truth("PROX_SSL", False)
         self.service = Env.get_or("PROX_SERVICE", "PVE")
+        self.cache_dir = os.path.expanduser(
+            Env.get_or("PROX_CACHE_DIR", "~/.cache/proxmox-export")
+        )
+        self.cache_ttl = int(Env.get_or("PROX_CACHE_TTL", 0))
+        self.key_cache = Env.get_or_truth("PROX_KEY_CACHE", False)
+        self.concurrency = int(Env.get_or("PROX_CONCURRENCY", 32))
+        if self.concurrency < 1:
+            raise ValueError("PROX_CONCURRENCY must be at least 1")
+        fields = Env.get_or("PROX_FIELDS", "").split(",")
+        self.fields = [f.strip() for f in fields if f.strip()]
+        self.batch_size = int(Env.get_or("PROX_BATCH_SIZE", 500))
+        self.poll_interval = float(Env.get_or("PROX_POLL_INTERVAL", 0))
+        if self.batch_size < 1:
+            raise ValueError("PROX_BATCH_SIZE must be at least 1")
+        if self.poll_interval < 0:
+            raise ValueError("PROX_POLL_INTERVAL must not be negative")
 
 
 def get_proxmox(config: Config):
@@ -52,11 +91,120 @@ def get_proxmox(config: Config):
     return proxmox
 
 
+class AsyncProxmox:
+    """aiohttp client sharing the ticket of an authenticated ProxmoxAPI"""
+
+    config: Config
+    base_url: str
+    session: aiohttp.ClientSession
+
+    def __init__(self, config: Config, proxmox: ProxmoxAPI):
+        self.config = config
+        # Reuse proxmoxer's resolved URL so IPv6 hosts and per-service
+        # default ports match
+        self.base_url = proxmox._store["base_url"]
+        ticket, _ = proxmox.get_tokens()
+        # Set the cookie header directly; aiohttp's cookie jar would quote
+        # the ticket's base64 padding and Proxmox would reject it
+        ticket = urllib.parse.quote(ticket, safe="")
+        self.headers = {"Cookie": f"{config.service}AuthCookie={ticket}"}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.config.concurrency, ssl=self.config.verify_ssl
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=self.headers
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get(self, path: str):
+        async with self.session.get(f"{self.base_url}/{path}") as resp:
+            resp.raise_for_status()
+            return orjson.loads(await resp.read())["data"]
+
+
+class ConfigCache:
+    """SQLite cache of qemu config keyed by node and vmid"""
+
+    flush_size: int
+    pending: list
+
+    def __init__(self, path: str, ttl: int, flush_size: int):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS config (node TEXT, vmid INT, payload BLOB,"
+            " ts INT, PRIMARY KEY(node, vmid))"
+        )
+        # Expired rows, including those of deleted VMs, are never read again
+        self.db.execute("DELETE FROM config WHERE ts < ?", (int(time.time()) - ttl,))
+        self.db.commit()
+        self.flush_size = flush_size
+        self.pending = []
+
+    def get(self, node: str, vmid: int):
+        row = self.db.execute(
+            "SELECT payload FROM config WHERE node = ? AND vmid = ?", (node, vmid)
+        ).fetchone()
+        if row is None:
+            return None
+        return orjson.loads(row[0])
+
+    def put(self, node: str, vmid: int, config: dict):
+        self.pending.append((node, vmid, orjson.dumps(config), int(time.time())))
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO config (node, vmid, payload, ts)"
+            " VALUES (?, ?, ?, ?)",
+            self.pending,
+        )
+        self.db.commit()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class KeyCache:
+    """Ordered config keys seen on previous runs, kept as JSON"""
+
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                keys = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return []
+        # A damaged file only costs the seeding, never the export
+        if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+            return []
+        return keys
+
+    def save(self, keys: list):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(orjson.dumps(keys))
+
+
 class NodeList:
-    list: list = []
+    list: list
     proxmox: any
 
     def __init__(self, proxmox):
+        self.list = []
         self.proxmox = proxmox
 
     def get(self):
@@ -68,93 +216,233 @@ class NodeList:
         return self.list
 
 
-class VMList:
-    node: NodeList
-    list: list
+class ClusterResources:
     proxmox: any
 
-    def __init__(self, node: NodeList, proxmox: any):
-        if len(node.get()) == 0:
-            raise ValueError("Node list empty")
-        self.node = node
-        self.list = []
+    def __init__(self, proxmox):
         self.proxmox = proxmox
 
-    def get(self):
-        if len(self.list) != 0:
-            return self.list
+    def list(self):
+        # One call for every guest in the cluster, lxc containers included
+        return [
+            vm
+            for vm in self.proxmox.cluster.resources.get(type="vm")
+            if vm["type"] == "qemu"
+        ]
+
+
+class VM:
+    vmid: int
+    node: str
+    api: AsyncProxmox
+    cache: ConfigCache
+    resource: dict
+    fields: list
+    _config_path: str
+
+    def __init__(
+        self, resource: dict, api: AsyncProxmox, cache: ConfigCache, fields: list
+    ):
+        self.vmid = int(resource["vmid"])
+        self.node = resource["node"]
+        self.api = api
+        self.cache = cache
+        self.resource = resource
+        self.fields = fields
+        self._config_path = f"nodes/{self.node}/qemu/{self.vmid}/config"
+
+    async def aget_config(self):
+        if self.cache is not None:
+            config = self.cache.get(self.node, self.vmid)
+            if config is not None:
+                return config
+
+        config = await self.api.get(self._config_path)
+        if self.cache is not None:
+            self.cache.put(self.node, self.vmid, config)
+        return config
+
+    async def aget(self):
+        if not self.fields:
+            return await self.aget_config()
+
+        # The guest listing already carries summary fields such as name and
+        # maxmem; only fetch the config when a requested field is not there
+        data = self.resource
+        if not all(field in data for field in self.fields):
+            data = {**data, **await self.aget_config()}
+        return {field: data[field] for field in self.fields if field in data}
 
-        for node in self.node.get():
-            for vm in self.proxmox.nodes(node).qemu.get():
-                vmid = int(vm["vmid"])
-                status = vm['status']
-                if status != "running":
-                    print(f"skipping {vmid} status {status}")
-                    continue
 
-                print(f"processing {vmid}")
-                self.list.append(self.proxmox.nodes(node).qemu(vmid).config.get())
+class VMList:
+    node: NodeList
+    proxmox: any
+    api: AsyncProxmox
+    cache: ConfigCache
+    fields: list
+    _key_set: set
+    _keys_ordered: list
+    _fields_seen: set
+
+    def __init__(
+        self,
+        node: NodeList,
+        proxmox: any,
+        api: AsyncProxmox,
+        cache: ConfigCache,
+        keys: list = (),
+        fields: list = (),
+    ):
+        self.node = node
+        self.proxmox = proxmox
+        self.api = api
+        self.cache = cache
+        self.fields = list(fields)
+        self._key_set = set(keys)
+        self._keys_ordered = list(keys)
+        self._fields_seen = set()
+        # Caps in-flight requests so large clusters don't flood the API
+        self.semaphore = asyncio.Semaphore(api.config.concurrency)
+
+    async def fetch(self, vm: VM, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self.semaphore:
+            print(f"processing {vm.vmid}")
+            return await vm.aget()
+
+    async def guests(self):
+        try:
+            return ClusterResources(self.proxmox).list()
+        except ResourceException as e:
+            print(f"cluster resources unavailable ({e}), listing per node")
 
-        self.normalise()
+        return await self._list_all_qemu()
 
-        return self.list
+    async def _list_all_qemu(self):
+        nodes = self.node.get()
+        if len(nodes) == 0:
+            raise ValueError("Node list empty")
 
-    def normalise(self):
-        keys = QemuConfig(self).get_keys()
-        # Ensure all keys exist for each vm for consistency
-        for vm in self.list:
-            for key in keys:
-                if key not in vm:
-                    vm[key] = ""
+        listings = await asyncio.gather(
+            *[self.api.get(f"nodes/{node}/qemu") for node in nodes]
+        )
+        guests = []
+        for node, listing in zip(nodes, listings):
+            for vm in listing:
+                guests.append({**vm, "node": node})
+        return guests
+
+    async def stream(self):
+        running = []
+        for guest in await self.guests():
+            if guest["status"] != "running":
+                print(f"skipping {guest['vmid']} status {guest['status']}")
+                continue
+            running.append(guest)
+
+        if len(running) == 0:
+            raise ValueError("VM list empty")
+        # Both listings come back in their own order; sort so exports diff
+        running.sort(key=lambda guest: int(guest["vmid"]))
+
+        # With a poll interval, each batch starts one interval after the
+        # previous one without waiting for it to finish, so very large
+        # clusters stay under API limits while the pipeline stays full
+        batch_size = self.api.config.batch_size
+        interval = self.api.config.poll_interval
+        tasks = [
+            asyncio.create_task(
+                self.fetch(
+                    VM(guest, self.api, self.cache, self.fields),
+                    (i // batch_size) * interval,
+                )
+            )
+            for i, guest in enumerate(running)
+        ]
+        # Rows go out in vmid order while later configs keep downloading
+        for task in tasks:
+            data = await task
+            self.track_keys(data)
+            self._fields_seen.update(data)
+            yield data
+
+        # A field no VM has (often a typo) forces a config fetch for every VM
+        missing = [field for field in self.fields if field not in self._fields_seen]
+        if missing:
+            print(
+                f"warning: PROX_FIELDS {missing} not found on any VM,"
+                " so every VM config was fetched looking for them"
+            )
+
+    def track_keys(self, data: dict):
+        for key in data:
+            if key not in self._key_set:
+                self._key_set.add(key)
+                self._keys_ordered.append(key)
 
     def keys(self):
-        return QemuConfig(self).get_keys()
-
+        return self._keys_ordered
 
-class QemuConfig:
-    keys: list
 
-    def __init__(self, vm: VMList):
-        if len(vm.get()) == 0:
-            raise ValueError("VM list empty")
-        self.vm = vm
-        self.keys = []
+class CSV:
+    chunk_size: int = 1000
 
-    def get_keys(self):
-        if len(self.keys) != 0:
-            return self.keys
+    @staticmethod
+    async def output(filename: str, data: AsyncIterator[dict], heading: Callable):
+        # The heading is only complete once every row has been seen, so
+        # rows are spooled to disk as they arrive and written out after
+        with tempfile.TemporaryFile("w+b") as spool:
+            async for item in data:
+                spool.write(orjson.dumps(item) + b"\n")
+            spool.seek(0)
+
+            try:
+                with open(filename, "w", buffering=1 << 16, newline="") as csvfile:
+                    writer = csv.DictWriter(
+                        csvfile, fieldnames=heading(), restval="", extrasaction="ignore"
+                    )
+                    writer.writeheader()
+                    chunk = []
+                    for line in spool:
+                        chunk.append(orjson.loads(line))
+                        if len(chunk) >= CSV.chunk_size:
+                            writer.writerows(chunk)
+                            chunk.clear()
+                    writer.writerows(chunk)
+            except IOError:
+                print("I/O error")
+
+
+async def run():
+    config = Config()
+    prox = get_proxmox(config)
+    node = NodeList(prox)
+    cache = None
+    if config.cache_ttl > 0:
+        path = os.path.join(config.cache_dir, "cache.sqlite")
+        cache = ConfigCache(path, config.cache_ttl, config.batch_size)
 
-        # Initialise heading list
-        self.keys = list(self.vm.get()[0])
-        # Ensure all keys exist
-        for vm in self.vm.get():
-            for item in vm:
-                if item not in self.keys:
-                    self.keys.append(item)
-        return self.keys
+    # Seed the heading with keys from earlier runs so columns stay stable
+    key_cache = KeyCache(os.path.join(config.cache_dir, "keys.json"))
+    known = key_cache.load() if config.key_cache else []
+    if config.fields:
+        known = config.fields
 
+    async with AsyncProxmox(config, prox) as api:
+        vm = VMList(node, prox, api, cache, known, config.fields)
+        await CSV.output("vmlist.csv", vm.stream(), vm.keys)
 
-class CSV:
-    @staticmethod
-    def output(filename: str, data: dict, heading: list):
-        try:
-            with open(filename, "w") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=heading)
-                writer.writeheader()
-                for item in data:
-                    writer.writerow(item)
-        except IOError:
-            print("I/O error")
+    # Only reached once every VM was fetched; a failed fetch raises above,
+    # leaving keys.json alone and unflushed config rows unwritten
+    if cache is not None:
+        cache.close()
+    if config.key_cache and not config.fields and len(vm.keys()) > len(known):
+        key_cache.save(vm.keys())
 
 
 def main():
-    config = Config()
-    prox = get_proxmox(config)
-    node = NodeList(prox)
-    vm = VMList(node, prox)
-    data = vm.get()
-
-    CSV.output("vmlist.csv", data, vm.keys())
+    asyncio.run(run())
 
 
 main()